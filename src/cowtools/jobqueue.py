@@ -0,0 +1,255 @@
+import atexit
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+from functools import lru_cache
+from pathlib import Path
+from types import MappingProxyType
+
+DEFAULT_SIF = "/home/vassal/notebook.sif"
+CONDOR_CONFIG = "/etc/condor/condor_config"
+# Images under these prefixes are visible on every worker, so they are referenced in
+# place instead of being shipped with transfer_input_files
+SHARED_FS_PREFIXES = ("/cvmfs/",)
+_USER = os.environ.get("USER") or os.environ.get("LOGNAME")
+_SCRATCH = f"/scratch/{_USER}" if _USER else None
+
+def _scratch_dir():
+    '''
+    Return the user's scratch directory, refusing to fall back to the shared /scratch
+    root when neither USER nor LOGNAME is set.
+    '''
+    if _SCRATCH is None:
+        raise RuntimeError(
+            "Could not determine the user's scratch directory: "
+            "neither USER nor LOGNAME is set"
+        )
+    return _SCRATCH
+
+# HTCondor submit directives shared by every job; per-call values are overlaid on a copy
+_BASE_DIRECTIVES = MappingProxyType({
+    "+JobFlavour": '"tomorrow"',
+    "log": "dask_job_output.$(PROCESS).$(CLUSTER).log",
+    "output": "dask_job_output.$(PROCESS).$(CLUSTER).out",
+    "error": "dask_job_output.$(PROCESS).$(CLUSTER).err",
+    "should_transfer_files": "yes",
+    "when_to_transfer_output": "ON_EXIT_OR_EVICT",
+    "Requirements": "HasSingularityJobStart",
+})
+
+# Clients handed out by GetDefaultCondorClient, keyed by the arguments that built them
+_client_cache = {}
+
+class _LazyClient:
+    '''
+    Stand-in for a dask.distributed.Client that only connects to the cluster the first
+    time it is used. Returned by GetDefaultCondorClient(..., lazy=True).
+    '''
+    def __init__(self, cluster):
+        self._cluster = cluster
+        self._client = None
+
+    def _resolve(self):
+        if self._client is None:
+            from dask.distributed import Client
+
+            self._client = Client(self._cluster)
+        return self._client
+
+    def __getattr__(self, name):
+        if name in ("_cluster", "_client"):
+            raise AttributeError(name)
+        return getattr(self._resolve(), name)
+
+    def __enter__(self):
+        return self._resolve().__enter__()
+
+    def __exit__(self, *args):
+        return self._resolve().__exit__(*args)
+
+def _is_running(client):
+    if isinstance(client, _LazyClient) and client._client is None:
+        # Not connected yet, so it is only as alive as the cluster it would connect to
+        from distributed.core import Status
+
+        return client._cluster.status == Status.running
+    return client.status == "running"
+
+def _close_cached_clients():
+    for client in _client_cache.values():
+        if isinstance(client, _LazyClient):
+            client = client._client
+        if client is not None:
+            client.close()
+
+atexit.register(_close_cached_clients)
+
+@lru_cache(maxsize=1)
+def _lookup_voms_proxy_path():
+    '''
+    Ask voms-proxy-info for the path to the current x509 proxy. The result is cached,
+    so the tool is only run once per process.
+
+    Returns:
+        (str) Path to the x509 proxy
+    '''
+    err_msg = "x509 proxy could not be parsed, try creating it with 'voms-proxy-init'"
+    try:
+        res = subprocess.run(
+            ["voms-proxy-info", "-path"],
+            capture_output=True,
+            text=True,
+            check=True,
+            timeout=10,
+        )
+    except (
+        subprocess.CalledProcessError,
+        FileNotFoundError,
+        subprocess.TimeoutExpired,
+    ) as err:
+        raise RuntimeError(err_msg) from err
+    _x509_localpath = res.stdout.strip()
+    if not _x509_localpath:
+        raise RuntimeError(err_msg)
+    return _x509_localpath
+
+def _copy_private(src, dst):
+    '''
+    Copy src to dst, leaving dst readable and writable by its owner only, as a proxy
+    must be (shutil.copyfile would create it with umask permissions, e.g. 0644).
+    The copy is written to a temporary file next to dst and renamed over it, so an
+    existing dst that is a hardlink to some other file is replaced, not written through.
+    '''
+    # mkstemp always creates the file as 0600
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dst), prefix=".x509-")
+    try:
+        with os.fdopen(fd, "wb") as d, open(src, "rb") as s:
+            shutil.copyfileobj(s, d)
+        os.replace(tmp_path, dst)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def move_x509():
+    '''
+    Get x509 path, copy it to the correct location, and return the path. Primarily
+    to be used in preparation for creating an HTCondorCluster object (like 
+    via GetDefaultCondorClient. If X509_USER_PROXY points to an existing file, it
+    is used directly, then the standard /tmp/x509up_u<uid> location is tried, and
+    voms-proxy-info is only run if neither exists.
+    '''
+    env_path = os.environ.get("X509_USER_PROXY")
+    default_path = f"/tmp/x509up_u{os.getuid()}"
+    if env_path and os.path.isfile(env_path):
+        _x509_localpath = env_path
+    elif os.path.isfile(default_path):
+        _x509_localpath = default_path
+    else:
+        _x509_localpath = _lookup_voms_proxy_path()
+    _x509_path = f'{_scratch_dir()}/{_x509_localpath.split("/")[-1]}'
+    try:
+        os.link(_x509_localpath, _x509_path)
+    except FileExistsError:
+        if not os.path.samefile(_x509_localpath, _x509_path):
+            _copy_private(_x509_localpath, _x509_path)
+    except OSError:
+        # e.g. EXDEV when the proxy and scratch are on different filesystems
+        _copy_private(_x509_localpath, _x509_path)
+    _x509_path = os.path.basename(_x509_localpath)
+    return _x509_path
+
+@lru_cache(maxsize=1)
+def _find_image():
+    '''
+    Find the Singularity image file to ship to workers. A custom image in the user's
+    scratch area takes precedence over DEFAULT_SIF. The result is cached, so the
+    lookup only touches the filesystem once per process.
+
+    Returns:
+        (str) Path to the Singularity image file
+    '''
+    custom_sif = Path(f"{_scratch_dir()}/notebook.sif")
+    if custom_sif.is_file():
+        return str(custom_sif)
+    return DEFAULT_SIF
+
+def GetDefaultCondorClient(
+    x509_path, max_workers=50, mem_size=2, disk_size=1, lazy=False, image=None
+):
+    '''
+    Get a dask.distributed.Client object that can be used for distributed computation with
+    an HTCondorCluster. Assumes some default settings for the cluster, including a reasonable
+    timeout, location for log/output/error files, and Singularity image file to ship.
+    Comms use dask_jobqueue's default protocol unless DASK_PROTOCOL is set (e.g. to
+    "ucx://", which needs UCX support on both the scheduler and in the worker image);
+    set DASK_INTERFACE (e.g. to "ib0") to choose the network interface.
+
+    Inputs:
+        x509_path: (str) Path to the x509 proxy to ship to workers
+        lazy: (bool) If True, return a stand-in that only connects the Client to the
+            cluster on first use, so this call does not block on the scheduler handshake
+        image: (str) Path to the Singularity image for the workers. Defaults to the
+            image found by _find_image. Images under SHARED_FS_PREFIXES (e.g. /cvmfs/)
+            are used in place by the workers rather than transferred to each job
+
+    Returns:
+        (dask.distributed.Client) A client connected to an HTCondor cluster. Calling
+        again with the same arguments returns the same client while it is still running.
+        With lazy=True this is instead a _LazyClient, which is not an instance of
+        dask.distributed.Client and only becomes dask's default client once one of its
+        attributes is used or it is entered as a context manager; until then,
+        dask.compute(...) runs on the local scheduler.
+    '''
+    key = (x509_path, max_workers, mem_size, disk_size, lazy, image)
+    cached = _client_cache.get(key)
+    if cached is not None and _is_running(cached):
+        return cached
+
+    # Imported here so that `import cowtools` does not pull in dask.distributed
+    from dask.distributed import Client
+    from dask_jobqueue import HTCondorCluster
+
+    if os.environ.get("CONDOR_CONFIG") != CONDOR_CONFIG:
+        os.environ["CONDOR_CONFIG"] = CONDOR_CONFIG
+
+    memory = str(mem_size) + " GB"
+    disk = str(disk_size) + " GB"
+    initial_dir = _scratch_dir()
+
+    sif_loc = _find_image() if image is None else image
+    shared_image = sif_loc.startswith(SHARED_FS_PREFIXES)
+    # A transferred image lands in the job sandbox under its own file name
+    singularity_image = sif_loc if shared_image else os.path.basename(sif_loc)
+    transfer_input_files = ",".join(
+        f for f in (x509_path, None if shared_image else sif_loc) if f
+    )
+
+    prologue_env = {
+        "XRD_RUNFORKHANDLER": "1",
+        "X509_USER_PROXY": x509_path,
+    }
+
+    cluster = HTCondorCluster(
+        cores=1,
+        memory=memory,
+        disk=disk,
+        death_timeout = '60',
+        protocol=os.environ.get("DASK_PROTOCOL"),
+        interface=os.environ.get("DASK_INTERFACE"),
+        job_extra_directives={
+            **_BASE_DIRECTIVES,
+            "+SingularityImage": f'"{singularity_image}"',
+            "InitialDir": initial_dir,
+            "transfer_input_files": transfer_input_files,
+        },
+        job_script_prologue=["export " + " ".join(
+            f"{k}={shlex.quote(v)}" for k, v in prologue_env.items()
+        )],
+    )
+    print('Condor logs, output files, error files in {}'.format(initial_dir))
+    cluster.adapt(minimum=1, maximum=max_workers)
+    client = _LazyClient(cluster) if lazy else Client(cluster)
+    _client_cache[key] = client
+    return client
@@ -1,4 +1,16 @@
+import errno
+import os
+import stat
+import subprocess
+
+import dask.distributed
+import dask_jobqueue
+import pytest
+from distributed.core import Status
+
 import cowtools
+from cowtools import jobqueue
+
 
 def test_GetDefaultCondorClient():
     """
@@ -20,3 +32,347 @@ def test_move_x509():
     x509_path = cowtools.move_x509()
     #check that move_x509 at least returns a string
     assert type(x509_path) == str
+
+
+# The tests below stub out HTCondor, Dask and voms-proxy-info, so they run anywhere
+
+@pytest.fixture(autouse=True)
+def _clear_caches():
+    jobqueue._client_cache.clear()
+    jobqueue._find_image.cache_clear()
+    jobqueue._lookup_voms_proxy_path.cache_clear()
+    yield
+    jobqueue._client_cache.clear()
+    jobqueue._find_image.cache_clear()
+    jobqueue._lookup_voms_proxy_path.cache_clear()
+
+
+@pytest.fixture
+def scratch(tmp_path, monkeypatch):
+    scratch_dir = tmp_path / "scratch"
+    scratch_dir.mkdir()
+    monkeypatch.setattr(jobqueue, "_SCRATCH", str(scratch_dir))
+    return scratch_dir
+
+
+@pytest.fixture
+def proxy(tmp_path, monkeypatch):
+    """
+    A fake proxy file, with the environment and the default /tmp location cleared so
+    that move_x509 only finds what a test explicitly points it at
+    """
+    proxy_file = tmp_path / "x509up_u12345"
+    proxy_file.write_text("proxy")
+    proxy_file.chmod(0o600)
+    monkeypatch.delenv("X509_USER_PROXY", raising=False)
+    monkeypatch.setattr(jobqueue.os, "getuid", lambda: 2**31 - 7)
+    return proxy_file
+
+
+class FakeCluster:
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.status = Status.running
+
+    def adapt(self, minimum, maximum):
+        self.adapt_range = (minimum, maximum)
+
+    def close(self):
+        self.status = Status.closed
+
+
+class FakeClient:
+    created = 0
+
+    def __init__(self, cluster):
+        FakeClient.created += 1
+        self.cluster = cluster
+        self.status = "running"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def close(self):
+        self.status = "closed"
+
+
+@pytest.fixture
+def fake_dask(monkeypatch, scratch):
+    FakeClient.created = 0
+    monkeypatch.setattr(dask_jobqueue, "HTCondorCluster", FakeCluster)
+    monkeypatch.setattr(dask.distributed, "Client", FakeClient)
+    monkeypatch.delenv("DASK_PROTOCOL", raising=False)
+
+
+def test_move_x509_voms_lookup(proxy, scratch, monkeypatch):
+    """
+    Test for move_x509()
+
+    Without an env or default proxy, the path comes from `voms-proxy-info -path`
+    """
+    calls = []
+
+    def fake_run(cmd, **kwargs):
+        calls.append(cmd)
+        return subprocess.CompletedProcess(cmd, 0, stdout=f"{proxy}\n")
+
+    monkeypatch.setattr(jobqueue.subprocess, "run", fake_run)
+    assert jobqueue.move_x509() == proxy.name
+    assert calls == [["voms-proxy-info", "-path"]]
+
+
+@pytest.mark.parametrize(
+    "outcome",
+    [
+        subprocess.CompletedProcess([], 0, stdout="\n"),
+        subprocess.CalledProcessError(1, []),
+        FileNotFoundError(),
+    ],
+)
+def test_move_x509_voms_failure(proxy, scratch, monkeypatch, outcome):
+    """
+    Test for move_x509()
+
+    Every way of not getting a proxy path ends in the voms-proxy-init hint
+    """
+    def fake_run(cmd, **kwargs):
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(jobqueue.subprocess, "run", fake_run)
+    with pytest.raises(RuntimeError, match="voms-proxy-init"):
+        jobqueue.move_x509()
+
+
+def test_move_x509_env_proxy(proxy, scratch, monkeypatch):
+    """
+    Test for move_x509()
+
+    X509_USER_PROXY is used without running voms-proxy-info
+    """
+    def no_voms(*args, **kwargs):
+        raise AssertionError("voms-proxy-info should not be run")
+
+    monkeypatch.setenv("X509_USER_PROXY", str(proxy))
+    monkeypatch.setattr(jobqueue.subprocess, "run", no_voms)
+    assert jobqueue.move_x509() == proxy.name
+    assert (scratch / proxy.name).read_text() == "proxy"
+
+
+def test_client_cache(fake_dask):
+    """
+    Test for the client cache in GetDefaultCondorClient()
+
+    Identical calls reuse a running client; new arguments or a closed client do not
+    """
+    client = jobqueue.GetDefaultCondorClient("x509up_u0")
+    assert jobqueue.GetDefaultCondorClient("x509up_u0") is client
+    assert FakeClient.created == 1
+
+    other = jobqueue.GetDefaultCondorClient("x509up_u0", max_workers=10)
+    assert other is not client
+    assert other.cluster.adapt_range == (1, 10)
+
+    client.close()
+    assert jobqueue.GetDefaultCondorClient("x509up_u0") is not client
+    assert FakeClient.created == 3
+
+
+def test_lazy_client(fake_dask):
+    """
+    Test for GetDefaultCondorClient(lazy=True)
+
+    The Client is only built on first use, and the stand-in works as a context manager
+    """
+    client = jobqueue.GetDefaultCondorClient("x509up_u0", lazy=True)
+    assert isinstance(client, jobqueue._LazyClient)
+    assert FakeClient.created == 0
+    assert jobqueue._is_running(client)
+    assert jobqueue.GetDefaultCondorClient("x509up_u0", lazy=True) is client
+
+    assert client.status == "running"
+    assert FakeClient.created == 1
+    with client as inner:
+        assert inner is client._client
+    assert FakeClient.created == 1
+
+
+def test_lazy_client_closed_cluster(fake_dask):
+    """
+    Test for GetDefaultCondorClient(lazy=True)
+
+    An unconnected stand-in is not reused once its cluster has been closed
+    """
+    client = jobqueue.GetDefaultCondorClient("x509up_u0", lazy=True)
+    client._cluster.close()
+    assert not jobqueue._is_running(client)
+    assert jobqueue.GetDefaultCondorClient("x509up_u0", lazy=True) is not client
+    assert FakeClient.created == 0
+
+
+def test_transfer_input_files(fake_dask):
+    """
+    Test for the transfer list in GetDefaultCondorClient()
+
+    Local images are shipped with the proxy, images on a shared filesystem are not
+    """
+    client = jobqueue.GetDefaultCondorClient("x509up_u0")
+    directives = client.cluster.kwargs["job_extra_directives"]
+    assert directives["transfer_input_files"] == f"x509up_u0,{jobqueue.DEFAULT_SIF}"
+    assert directives["+SingularityImage"] == '"notebook.sif"'
+
+    local_image = "/data/images/coffea.sif"
+    client = jobqueue.GetDefaultCondorClient("x509up_u0", image=local_image)
+    directives = client.cluster.kwargs["job_extra_directives"]
+    assert directives["transfer_input_files"] == f"x509up_u0,{local_image}"
+    assert directives["+SingularityImage"] == '"coffea.sif"'
+
+    cvmfs_image = "/cvmfs/unpacked.cern.ch/some/image"
+    client = jobqueue.GetDefaultCondorClient("x509up_u0", image=cvmfs_image)
+    directives = client.cluster.kwargs["job_extra_directives"]
+    assert directives["transfer_input_files"] == "x509up_u0"
+    assert directives["+SingularityImage"] == f'"{cvmfs_image}"'
+
+
+def test_default_protocol(fake_dask, monkeypatch):
+    """
+    Test for the comms protocol in GetDefaultCondorClient()
+
+    dask_jobqueue's default is kept unless DASK_PROTOCOL asks for something else
+    """
+    client = jobqueue.GetDefaultCondorClient("x509up_u0")
+    assert client.cluster.kwargs["protocol"] is None
+
+    monkeypatch.setenv("DASK_PROTOCOL", "ucx://")
+    client = jobqueue.GetDefaultCondorClient("x509up_u0", max_workers=10)
+    assert client.cluster.kwargs["protocol"] == "ucx://"
+
+
+def test_scratch_dir_requires_user(monkeypatch):
+    """
+    Test for _scratch_dir()
+
+    Make sure we refuse to fall back to the shared /scratch root without a user name
+    """
+    monkeypatch.setattr(jobqueue, "_SCRATCH", None)
+    with pytest.raises(RuntimeError):
+        jobqueue._scratch_dir()
+
+
+def test_move_x509_hardlink(proxy, scratch, monkeypatch):
+    """
+    Test for move_x509()
+
+    The proxy is hardlinked into scratch, and moving it again is a no-op
+    """
+    monkeypatch.setenv("X509_USER_PROXY", str(proxy))
+    assert jobqueue.move_x509() == proxy.name
+    assert (scratch / proxy.name).stat().st_nlink == 2
+    assert jobqueue.move_x509() == proxy.name
+    assert (scratch / proxy.name).read_text() == "proxy"
+
+
+def test_move_x509_overwrites_stale_copy(proxy, scratch, monkeypatch):
+    """
+    Test for move_x509()
+
+    A different file already in scratch is replaced with the current proxy
+    """
+    monkeypatch.setenv("X509_USER_PROXY", str(proxy))
+    (scratch / proxy.name).write_text("stale")
+    jobqueue.move_x509()
+    assert (scratch / proxy.name).read_text() == "proxy"
+
+
+def test_move_x509_replaces_old_hardlink(proxy, scratch, tmp_path, monkeypatch):
+    """
+    Test for move_x509()
+
+    Moving a new proxy over one hardlinked from elsewhere leaves the old source intact
+    """
+    old_proxy = tmp_path / "old" / proxy.name
+    old_proxy.parent.mkdir()
+    old_proxy.write_text("old proxy")
+    monkeypatch.setenv("X509_USER_PROXY", str(old_proxy))
+    jobqueue.move_x509()
+
+    monkeypatch.setenv("X509_USER_PROXY", str(proxy))
+    jobqueue.move_x509()
+    assert (scratch / proxy.name).read_text() == "proxy"
+    assert old_proxy.read_text() == "old proxy"
+    assert list(scratch.iterdir()) == [scratch / proxy.name]
+
+
+def test_move_x509_cross_device(proxy, scratch, monkeypatch):
+    """
+    Test for move_x509()
+
+    When hardlinking fails with EXDEV, the proxy is copied instead
+    """
+    def cross_device(src, dst):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+    monkeypatch.setenv("X509_USER_PROXY", str(proxy))
+    monkeypatch.setattr(jobqueue.os, "link", cross_device)
+    jobqueue.move_x509()
+    copied = scratch / proxy.name
+    assert copied.read_text() == "proxy"
+    assert copied.stat().st_nlink == 1
+
+
+def test_move_x509_default_location(proxy, scratch, monkeypatch):
+    """
+    Test for move_x509()
+
+    /tmp/x509up_u<uid> is used when X509_USER_PROXY is not set
+    """
+    default_path = f"/tmp/x509up_u{jobqueue.os.getuid()}"
+    real_isfile = jobqueue.os.path.isfile
+    monkeypatch.setattr(
+        jobqueue.os.path, "isfile", lambda p: p == default_path or real_isfile(p)
+    )
+    linked = []
+    monkeypatch.setattr(jobqueue.os, "link", lambda src, dst: linked.append(src))
+    assert jobqueue.move_x509() == os.path.basename(default_path)
+    assert linked == [default_path]
+
+
+def test_job_script_prologue(fake_dask):
+    """
+    Test for the worker prologue in GetDefaultCondorClient()
+
+    All variables are exported in one line, with values shell-quoted
+    """
+    client = jobqueue.GetDefaultCondorClient("x509 proxy")
+    assert client.cluster.kwargs["job_script_prologue"] == [
+        "export XRD_RUNFORKHANDLER=1 X509_USER_PROXY='x509 proxy'"
+    ]
+
+
+@pytest.mark.parametrize("stale_mode", [None, 0o644])
+def test_move_x509_copy_is_private(proxy, scratch, monkeypatch, stale_mode):
+    """
+    Test for move_x509()
+
+    A copied proxy is mode 0600 regardless of umask or of an existing looser file
+    """
+    def cross_device(src, dst):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+    monkeypatch.setenv("X509_USER_PROXY", str(proxy))
+    monkeypatch.setattr(jobqueue.os, "link", cross_device)
+    copied = scratch / proxy.name
+    if stale_mode is not None:
+        copied.write_text("stale")
+        copied.chmod(stale_mode)
+    old_umask = os.umask(0o022)
+    try:
+        jobqueue.move_x509()
+    finally:
+        os.umask(old_umask)
+    assert copied.read_text() == "proxy"
+    assert stat.S_IMODE(copied.stat().st_mode) == 0o600